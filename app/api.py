@@ -1,9 +1,15 @@
 # app/api.py
+import hmac
+import json
 import os
+import threading
 import time
+from contextlib import asynccontextmanager
+from typing import Optional
 
 import sentry_sdk
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Header, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import FileResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from loguru import logger
@@ -18,13 +24,21 @@ def rate_limit_exceeded_handler(request: Request, exc: RateLimitExceeded):
     return JSONResponse(
         status_code=429,
         content={
-            "answer": "You've sent too many requests. Please wait a minute before trying again. (Limit: 10 requests per minute)",
+            "answer": f"You've sent too many requests. Please wait a minute before trying again. (Limit: {RATE_LIMIT})",
             "sources": [],
             "prompt_name": "error",
         },
     )
 
-from app.rag_core import answer_question, available_prompts, INDEX_PATH
+from app.deadline import Deadline
+from app.rag_core import (
+    REQUEST_DEADLINE_S,
+    answer_question,
+    available_prompts,
+    index_status,
+    reload_index,
+    start_index_watcher,
+)
 
 # ─────────────────────────────────────────────────────────────────────────────
 # Sentry 错误追踪
@@ -56,12 +70,74 @@ logger.add(
 # ─────────────────────────────────────────────────────────────────────────────
 # Rate Limiting
 # ─────────────────────────────────────────────────────────────────────────────
+# 压测时可以调高，例如 RATE_LIMIT="1000/minute"
+RATE_LIMIT = os.getenv("RATE_LIMIT", "10/minute")
 limiter = Limiter(key_func=get_remote_address)
 
-app = FastAPI(title="CS104 QA RAG")
+# 启动时后台预热索引，并轮询新版本做热切换
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    start_index_watcher()
+    yield
+
+
+app = FastAPI(title="CS104 QA RAG", lifespan=lifespan)
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, rate_limit_exceeded_handler)
 
+# ─────────────────────────────────────────────────────────────────────────────
+# 流量录制（可选，供 loadtest/replay.py 回放）
+# ─────────────────────────────────────────────────────────────────────────────
+TRAFFIC_LOG_PATH = os.getenv("TRAFFIC_LOG_PATH")
+_traffic_lock = threading.Lock()
+
+
+def record_traffic(req: "QueryReq") -> None:
+    """把一次查询追加到 JSONL（timestamp, question, prompt_name, top_k）。"""
+    if not TRAFFIC_LOG_PATH:
+        return
+    line = json.dumps(
+        {
+            "ts": time.time(),
+            "question": req.question,
+            "prompt_name": req.prompt_name,
+            "top_k": req.top_k,
+        },
+        ensure_ascii=False,
+    )
+    try:
+        with _traffic_lock:
+            with open(TRAFFIC_LOG_PATH, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+    except OSError as e:
+        logger.warning(f"Traffic recording failed: {e}")
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# 请求计时 + 流量录制：排队延迟 = 进入服务 → 线程池开始执行 handler
+# ─────────────────────────────────────────────────────────────────────────────
+@app.middleware("http")
+async def timing_headers(request: Request, call_next):
+    request.state.received_at = time.perf_counter()
+    if TRAFFIC_LOG_PATH and request.method == "POST" and request.url.path == "/query":
+        # 在限流之前录制，被 429 拒绝的请求也算到达流量
+        try:
+            req = QueryReq(**json.loads(await request.body()))
+        except Exception as e:
+            # 非法请求体交给 handler 返回 422
+            logger.debug(f"Traffic record dropped (invalid body): {e}")
+        else:
+            # 写文件放到线程池，不阻塞 event loop（否则会抬高要测的排队延迟）
+            await run_in_threadpool(record_traffic, req)
+    response = await call_next(request)
+    elapsed = time.perf_counter() - request.state.received_at
+    response.headers["X-Process-Time-Ms"] = f"{elapsed * 1000:.1f}"
+    queue_delay = getattr(request.state, "queue_delay", None)
+    if queue_delay is not None:
+        response.headers["X-Queue-Delay-Ms"] = f"{queue_delay * 1000:.1f}"
+    return response
+
+
 # 静态网页
 app.mount("/static", StaticFiles(directory="web/static"), name="static")
 
@@ -87,33 +163,59 @@ def prompts():
 # ─────────────────────────────────────────────────────────────────────────────
 @app.get("/health")
 def health():
-    index_exists = os.path.isdir(INDEX_PATH)
-    return {
-        "status": "ok",
-        "index_loaded": index_exists,
-        "index_path": INDEX_PATH,
-    }
+    return {"status": "ok", **index_status()}
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# 索引热切换（手动触发；需要 ADMIN_TOKEN）
+# ─────────────────────────────────────────────────────────────────────────────
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+
+@app.post("/admin/reload-index")
+def reload_index_now(x_admin_token: Optional[str] = Header(default=None)):
+    if not ADMIN_TOKEN or not hmac.compare_digest(
+        (x_admin_token or "").encode(), ADMIN_TOKEN.encode()
+    ):
+        return JSONResponse(status_code=403, content={"detail": "Forbidden"})
+
+    previous = index_status()["index_version"]
+    try:
+        version = reload_index()
+    except Exception as e:
+        logger.error(f"Index reload failed: {e}")
+        return JSONResponse(
+            status_code=500,
+            content={"detail": f"Index reload failed: {e}", "index_version": previous},
+        )
+    return {"index_version": version, "previous_version": previous}
 
 
 # ─────────────────────────────────────────────────────────────────────────────
 # 查询端点（带限流）
 # ─────────────────────────────────────────────────────────────────────────────
 @app.post("/query")
-@limiter.limit("10/minute")
+@limiter.limit(RATE_LIMIT)
 def query(request: Request, req: QueryReq):
     start_time = time.time()
+    received_at = getattr(request.state, "received_at", None)
+    if received_at is not None:
+        request.state.queue_delay = time.perf_counter() - received_at
     client_ip = get_remote_address(request)
 
     logger.info(f"Query from {client_ip}: {req.question[:50]}...")
 
     try:
+        # deadline 从请求到达算起，线程池排队时间也计入
         result = answer_question(
             question=req.question,
             prompt_name=req.prompt_name,
             similarity_top_k=req.top_k,
+            deadline=Deadline(REQUEST_DEADLINE_S, start=received_at),
         )
         elapsed = time.time() - start_time
-        logger.info(f"Query completed in {elapsed:.2f}s for {client_ip}")
+        status = "degraded" if result.get("degraded") else "completed"
+        logger.info(f"Query {status} in {elapsed:.2f}s for {client_ip}")
         return result
     except Exception as e:
         elapsed = time.time() - start_time
@@ -0,0 +1,169 @@
+# app/deadline.py
+"""
+请求级 deadline + hedged 调用，用来压住上游（embedding / LLM）的长尾延迟。
+
+- Deadline: 整个请求的时间预算，按阶段切分（embed / retrieve / synthesize）。
+- LatencyTracker: 记录每个阶段最近的耗时，给出分位数作为 hedge 触发阈值。
+- hedged_call: 先发一次；超过阈值还没回来就再发一份，谁先成功用谁；失败在预算内重试。
+"""
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Deque, Dict, List, Optional, TypeVar
+
+import openai
+from loguru import logger
+
+T = TypeVar("T")
+
+
+class DeadlineExceeded(Exception):
+    """某个阶段在分配的时间内没有完成。"""
+
+
+class Deadline:
+    def __init__(self, seconds: float, start: Optional[float] = None):
+        # start 用 time.perf_counter() 的时间点，可以从请求到达时算起（包含排队时间）
+        self.total = seconds
+        self.expires_at = (start if start is not None else time.perf_counter()) + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.perf_counter())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0.0
+
+    def budget(self, share: Optional[float] = None) -> float:
+        """某个阶段可用的时间：总预算的 share，但不超过剩余时间；None 表示剩下的全给它。"""
+        if share is None:
+            return self.remaining()
+        return min(self.remaining(), self.total * share)
+
+
+class LatencyTracker:
+    """线程安全的滑动窗口耗时统计。"""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._samples: Deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, p: float) -> Optional[float]:
+        """样本不够时返回 None。"""
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            xs = sorted(self._samples)
+        k = max(0, min(len(xs) - 1, math.ceil(len(xs) * p / 100.0) - 1))
+        return xs[k]
+
+
+_trackers: Dict[str, LatencyTracker] = {}
+_trackers_lock = threading.Lock()
+
+
+def get_tracker(stage: str) -> LatencyTracker:
+    with _trackers_lock:
+        if stage not in _trackers:
+            _trackers[stage] = LatencyTracker()
+        return _trackers[stage]
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """只重试上游的临时错误：429、连接错误 / 超时、5xx。401/400 和代码错误直接抛出。"""
+    if isinstance(exc, (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    return isinstance(exc, openai.APIStatusError) and exc.status_code >= 500
+
+
+def hedged_call(
+    fn: Callable[[float], T],
+    timeout: float,
+    stage: str,
+    hedge_percentile: Optional[float] = 95.0,
+    default_hedge_delay: Optional[float] = None,
+    retries: int = 0,
+    backoff: float = 0.2,
+    retryable: Callable[[BaseException], bool] = is_retryable,
+) -> T:
+    """
+    在 timeout 秒内调用 fn(剩余秒数)，必要时 hedge 一次、失败重试最多 retries 次。
+
+    fn 必须把传入的剩余秒数用作上游 client 的超时，这样没用上的那一份
+    （输掉的 hedge、超时的调用）最晚在本阶段结束时退出，不会一直占着线程。
+
+    hedge 阈值 = 该阶段最近耗时的 hedge_percentile 分位数；样本不够时用 default_hedge_delay，
+    为 None 则先不 hedge（避免冷启动时每个调用都发两份）。hedge_percentile=None 时不 hedge。
+    只有 retryable(exc) 为真的错误才重试，其它错误立即抛出。
+    超时抛 DeadlineExceeded；所有尝试都失败则抛第一个异常。
+    """
+    if timeout <= 0:
+        raise DeadlineExceeded(f"{stage}: no time left")
+
+    tracker = get_tracker(stage)
+    start = time.perf_counter()
+
+    def remaining() -> float:
+        return timeout - (time.perf_counter() - start)
+
+    def timed(budget: float) -> T:
+        t0 = time.perf_counter()
+        result = fn(budget)
+        tracker.record(time.perf_counter() - t0)
+        return result
+
+    # 每次调用自己的线程池，慢调用不会把其它请求的线程耗光；
+    # shutdown(wait=False) 后，残留的调用在自己的超时到了以后自行结束
+    executor = ThreadPoolExecutor(max_workers=2 + retries, thread_name_prefix=f"hedge-{stage}")
+    try:
+        pending: List[Future] = [executor.submit(timed, remaining())]
+        errors: List[BaseException] = []
+        hedged = hedge_percentile is None
+
+        while pending:
+            left = remaining()
+            if left <= 0:
+                break
+
+            wait_for = left
+            threshold = None if hedged else (tracker.percentile(hedge_percentile) or default_hedge_delay)
+            if threshold is not None:
+                wait_for = min(left, max(threshold - (timeout - left), 0.0))
+
+            done, not_done = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+            pending = list(not_done)
+            for fut in done:
+                exc = fut.exception()
+                if exc is None:
+                    return fut.result()
+                if not retryable(exc):
+                    raise exc
+                errors.append(exc)
+
+            if not done and threshold is not None:
+                # 超过阈值还没回来：再发一份，谁先成功用谁
+                hedged = True
+                logger.info(f"Hedging {stage} after {timeout - remaining():.2f}s")
+                pending.append(executor.submit(timed, remaining()))
+            elif not pending and retries > 0:
+                # 全部失败（429 / 5xx 等）：退避后重试，退避时间也受本阶段预算限制
+                retries -= 1
+                pause = min(backoff * 2 ** (len(errors) - 1), remaining())
+                logger.warning(f"Retrying {stage} after error: {errors[-1]}")
+                if pause > 0:
+                    time.sleep(pause)
+                if remaining() > 0:
+                    pending.append(executor.submit(timed, remaining()))
+    finally:
+        executor.shutdown(wait=False)
+
+    if errors and not pending:
+        raise errors[0]
+    raise DeadlineExceeded(f"{stage}: exceeded {timeout:.2f}s")
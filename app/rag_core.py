@@ -1,7 +1,9 @@
 # app/rag_core.py
 import os
+import threading
+import time
 from functools import lru_cache
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 # Load .env file if present (for local development)
 try:
@@ -10,15 +12,37 @@ try:
 except ImportError:
     pass  # python-dotenv not installed, use system env vars
 
-from llama_index.core import StorageContext, load_index_from_storage
+import openai
+from llama_index.core import StorageContext, get_response_synthesizer, load_index_from_storage
+from llama_index.core.schema import QueryBundle
 from llama_index.llms.openai import OpenAI
 from llama_index.embeddings.openai import OpenAIEmbedding
+from loguru import logger
+
+from app.deadline import Deadline, DeadlineExceeded, hedged_call
+from indexer.snapshot import read_current, snapshot_dir
 
 
 INDEX_PATH = os.getenv("INDEX_PATH", "data/processed/index")
+# build_index.py 写出的版本化快照（INDEX_SNAPSHOT_ROOT，见 indexer/snapshot.py）；CURRENT 存在时优先于 INDEX_PATH
+# 轮询 CURRENT 的间隔（秒），0 表示只在启动时加载一次
+INDEX_POLL_INTERVAL_S = float(os.getenv("INDEX_POLL_INTERVAL_S", "30"))
 LLM_MODEL = os.getenv("LLM_MODEL", "gpt-4o-mini")
 EMBED_MODEL = os.getenv("EMBED_MODEL", "text-embedding-3-small")
 
+# 整个请求的时间预算（秒）：embed 最多拿 EMBED_BUDGET 比例，本地检索不计，synthesize 拿剩下的全部
+REQUEST_DEADLINE_S = float(os.getenv("REQUEST_DEADLINE_S", "20"))
+EMBED_BUDGET = float(os.getenv("EMBED_BUDGET", "0.15"))
+# 某阶段耗时超过最近的该分位数就发 hedge 请求；设为 0 关闭 hedge
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+# 上游 429 / 5xx 的重试次数；由 hedged_call 在阶段预算内执行（client 自带的重试会越过 deadline）
+UPSTREAM_RETRIES = int(os.getenv("UPSTREAM_RETRIES", "2"))
+
+FALLBACK_ANSWER = (
+    "Sorry, I couldn't put together an answer in time. "
+    "The course materials below look most relevant, please check them directly."
+)
+
 
 def _load_prompt_library():
     """
@@ -57,21 +81,143 @@ get_prompt, list_prompts = _load_prompt_library()
 
 
 @lru_cache(maxsize=1)
-def get_query_engine(similarity_top_k: int = 10):
-    """Load index once and construct query engine once."""
-    storage_context = StorageContext.from_defaults(persist_dir=INDEX_PATH)
-    index = load_index_from_storage(storage_context)
-
-    llm = OpenAI(model=LLM_MODEL, temperature=0, seed=42)
-    embed_model = OpenAIEmbedding(model=EMBED_MODEL)
-
-    # 用 index.as_query_engine 走最简单的 RAG：retrieve + synthesize
-    qe = index.as_query_engine(
-        similarity_top_k=similarity_top_k,
-        llm=llm,
-        embed_model=embed_model,
+def _http_client() -> openai.DefaultHttpxClient:
+    """所有上游调用共用一个连接池（沿用 OpenAI SDK 的默认连接数上限）；每次调用的超时单独设置。"""
+    return openai.DefaultHttpxClient()
+
+
+def make_llm(timeout: float = REQUEST_DEADLINE_S) -> OpenAI:
+    return OpenAI(
+        model=LLM_MODEL,
+        temperature=0,
+        seed=42,
+        timeout=timeout,
+        max_retries=0,
+        http_client=_http_client(),
     )
-    return qe
+
+
+def make_embed_model(timeout: float = REQUEST_DEADLINE_S) -> OpenAIEmbedding:
+    return OpenAIEmbedding(
+        model=EMBED_MODEL,
+        timeout=timeout,
+        max_retries=0,
+        http_client=_http_client(),
+    )
+
+
+@lru_cache(maxsize=1)
+def get_embed_model() -> OpenAIEmbedding:
+    """retriever 需要一个 embed_model；请求路径上的 embedding 调用用 make_embed_model 按阶段预算建。"""
+    return make_embed_model()
+
+
+def resolve_index_version() -> Tuple[str, str]:
+    """(version, path)：优先读快照目录的 CURRENT，没有就回退到 INDEX_PATH。"""
+    version = read_current()
+    if version:
+        return version, snapshot_dir(version)
+    return "base", INDEX_PATH
+
+
+class IndexSnapshot:
+    """一个加载好的索引版本。加载完成后只读，可以被多个请求同时使用。"""
+
+    MAX_RETRIEVERS = 8
+
+    def __init__(self, version: str, path: str):
+        self.version = version
+        self.path = path
+        storage_context = StorageContext.from_defaults(persist_dir=path)
+        self.index = load_index_from_storage(storage_context)
+        self._retrievers: Dict[int, Any] = {}
+        self._lock = threading.Lock()
+
+    def retriever(self, similarity_top_k: int = 10):
+        with self._lock:
+            r = self._retrievers.get(similarity_top_k)
+            if r is None:
+                if len(self._retrievers) >= self.MAX_RETRIEVERS:
+                    self._retrievers.clear()
+                # synthesize 在 answer_question 里按阶段预算单独做，这里只负责检索
+                r = self.index.as_retriever(
+                    similarity_top_k=similarity_top_k,
+                    embed_model=get_embed_model(),
+                )
+                self._retrievers[similarity_top_k] = r
+            return r
+
+
+# 当前服务中的索引。换版本只是替换这个引用：
+# 进行中的请求已经拿到旧 snapshot 的引用，会在旧版本上跑完
+_snapshot: Optional[IndexSnapshot] = None
+_load_lock = threading.Lock()  # 串行化加载，请求路径不拿这把锁
+
+
+def reload_index(force: bool = False) -> str:
+    """CURRENT 变了就加载新版本并原子替换，返回当前版本号。"""
+    global _snapshot
+    with _load_lock:
+        version, path = resolve_index_version()
+        if not force and _snapshot is not None and _snapshot.version == version:
+            return version
+
+        t0 = time.time()
+        try:
+            snap = IndexSnapshot(version, path)
+        except Exception as e:
+            # 冷启动时 CURRENT 指向的快照坏了：先用 INDEX_PATH 顶上，保证能服务
+            if _snapshot is not None or path == INDEX_PATH:
+                raise
+            logger.error(f"Index {version} failed to load ({e}); falling back to {INDEX_PATH}")
+            version, path = "base", INDEX_PATH
+            snap = IndexSnapshot(version, path)
+        snap.retriever()  # 预热默认 top_k
+        old = _snapshot
+        _snapshot = snap
+        logger.info(
+            f"Index {version} loaded in {time.time() - t0:.2f}s"
+            + (f" (replaced {old.version})" if old else "")
+        )
+        return version
+
+
+def current_snapshot() -> IndexSnapshot:
+    snap = _snapshot
+    if snap is None:
+        try:
+            reload_index()
+        except Exception as e:
+            raise RuntimeError(f"No index loaded: {e}") from e
+        snap = _snapshot
+        if snap is None:
+            raise RuntimeError("No index loaded")
+    return snap
+
+
+def index_status() -> Dict[str, Any]:
+    snap = _snapshot
+    if snap is None:
+        _, path = resolve_index_version()
+        return {"index_loaded": False, "index_version": None, "index_path": path}
+    return {"index_loaded": True, "index_version": snap.version, "index_path": snap.path}
+
+
+def start_index_watcher(interval: float = INDEX_POLL_INTERVAL_S) -> None:
+    """后台线程：先预热加载，再定期检查 CURRENT，有新版本就热切换。"""
+
+    def loop():
+        while True:
+            try:
+                reload_index()
+            except Exception as e:
+                # 新版本加载失败就继续用旧的
+                logger.error(f"Index reload failed: {e}")
+            if interval <= 0:
+                return
+            time.sleep(interval)
+
+    threading.Thread(target=loop, name="index-watcher", daemon=True).start()
 
 
 def _pretty_source(md: Dict[str, Any]) -> str:
@@ -94,33 +240,83 @@ def _pretty_source(md: Dict[str, Any]) -> str:
     return "(unknown source)"
 
 
+def _collect_sources(nodes) -> List[str]:
+    """sources 去重（建索引时合并掉的重复 chunk 来源记在 duplicate_sources 里）"""
+    sources: List[str] = []
+    seen = set()
+    for sn in nodes or []:
+        md = sn.metadata or {}
+        candidates = [_pretty_source(md)]
+        candidates += [_pretty_source({"url": d, "file_path": d}) for d in md.get("duplicate_sources") or []]
+        for s in candidates:
+            if s not in seen:
+                sources.append(s)
+                seen.add(s)
+    return sources
+
+
 def answer_question(
     question: str,
     prompt_name: str = "ta_friendly",
     similarity_top_k: int = 10,
+    deadline: Optional[Deadline] = None,
 ) -> Dict[str, Any]:
-    qe = get_query_engine(similarity_top_k=similarity_top_k)
+    # 整个请求固定用同一个 snapshot，中途换版本不影响它
+    snap = current_snapshot()
+    retriever = snap.retriever(similarity_top_k)
+    deadline = deadline or Deadline(REQUEST_DEADLINE_S)
+    hedge_p = HEDGE_PERCENTILE or None
 
     # 关键点：把“system prompt”注入到 query engine 的 response synthesizer prompt
     # 最省事做法：直接在问题前拼一个指令（MVP 够用、效果稳定）
 
     system = get_prompt(prompt_name).strip()
     q = f"{system}\n\nStudent question: {question.strip()}"
-    resp = qe.query(q)
 
-    # sources 去重
-    sources: List[str] = []
-    seen = set()
-    for sn in getattr(resp, "source_nodes", []) or []:
-        s = _pretty_source(sn.metadata or {})
-        if s not in seen:
-            sources.append(s)
-            seen.add(s)
+    # 分阶段执行，每一步都有时间上限：embed → retrieve → synthesize
+    # 每次上游调用的 client 超时 = 本阶段剩余预算，没用上的调用到阶段结束就退出
+    nodes: List[Any] = []
+    try:
+        embedding = hedged_call(
+            lambda t: make_embed_model(t).get_query_embedding(q),
+            timeout=deadline.budget(EMBED_BUDGET),
+            stage="embed",
+            hedge_percentile=hedge_p,
+            retries=UPSTREAM_RETRIES,
+        )
+        if embedding is None:
+            raise RuntimeError("Query embedding returned None")
+        bundle = QueryBundle(query_str=q, embedding=embedding)
+
+        # 本地内存向量检索（embedding 已给出），直接在当前线程跑
+        nodes = retriever.retrieve(bundle)
+
+        resp = hedged_call(
+            lambda t: get_response_synthesizer(llm=make_llm(t)).synthesize(bundle, nodes),
+            timeout=deadline.budget(),
+            stage="synthesize",
+            hedge_percentile=hedge_p,
+            retries=UPSTREAM_RETRIES,
+        )
+    except Exception as e:
+        # 超时，或检索完成后 LLM 出错：降级返回来源 + 提示，而不是 500
+        if not isinstance(e, DeadlineExceeded) and not nodes:
+            raise
+        logger.warning(f"Returning fallback answer: {e}")
+        return {
+            "answer": FALLBACK_ANSWER,
+            "sources": _collect_sources(nodes),
+            "prompt_name": prompt_name,
+            "degraded": True,
+            "index_version": snap.version,
+        }
 
     return {
         "answer": str(resp).strip(),
-        "sources": sources,
+        "sources": _collect_sources(getattr(resp, "source_nodes", None)),
         "prompt_name": prompt_name,
+        "degraded": False,
+        "index_version": snap.version,
     }
 
 
@@ -1,16 +1,26 @@
 # app/rag_query.py
 
-import time
-from llama_index.core import StorageContext, load_index_from_storage
-from llama_index.llms.openai import OpenAI
-from llama_index.embeddings.openai import OpenAIEmbedding
+from llama_index.core import StorageContext, get_response_synthesizer, load_index_from_storage
 from llama_index.core.schema import QueryBundle
 from llama_index.core.prompts import PromptTemplate
 from prompt.prompt_lib import get_prompt, list_prompts
+from app.deadline import Deadline, DeadlineExceeded, hedged_call
+from app.rag_core import (
+    EMBED_BUDGET,
+    FALLBACK_ANSWER,
+    HEDGE_PERCENTILE,
+    REQUEST_DEADLINE_S,
+    UPSTREAM_RETRIES,
+    get_embed_model,
+    make_embed_model,
+    make_llm,
+    resolve_index_version,
+)
 
 
 
-INDEX_PATH = "data/processed/index"
+INDEX_VERSION, INDEX_PATH = resolve_index_version()
+print(f"[Index] version={INDEX_VERSION} path={INDEX_PATH}")
 storage_context = StorageContext.from_defaults(persist_dir=INDEX_PATH)
 index = load_index_from_storage(storage_context)
 
@@ -20,16 +30,8 @@ qa_prompt = get_prompt(PROMPT_NAME)
 
 
 
-llm = OpenAI(model="gpt-4o-mini", temperature=0)
-embed_model = OpenAIEmbedding(model="text-embedding-3-small")
-
-retriever = index.as_retriever(similarity_top_k=10)   # 只负责检索
-query_engine = index.as_query_engine(
-    similarity_top_k=10,
-    llm=llm,
-    embed_model=embed_model,
-    text_qa_template=qa_prompt
-)
+# 只负责检索；LLM 在 safe_query 里按阶段预算建（超时 = 剩余预算，不走 SDK 自带重试）
+retriever = index.as_retriever(similarity_top_k=10, embed_model=get_embed_model())
 
 def is_valid_query(q: str) -> bool:
     if not q:
@@ -43,25 +45,49 @@ def is_valid_query(q: str) -> bool:
     return True
 
 
-def safe_query(q: str, retries=5, backoff=1.5):
+def safe_query(q: str, deadline_s: float = REQUEST_DEADLINE_S):
+    """和 rag_core.answer_question 一样分阶段执行，返回 (answer, source_nodes)；超时返回兜底回答。"""
     if not is_valid_query(q):
         raise ValueError("Query is not a valid natural-language question.")
-    # 先确保 query embedding 成功（避免 None）
-    last_err = None
-    for i in range(retries):
-        try:
-            emb = embed_model.get_query_embedding(q)
-            if emb is None:
-                raise RuntimeError("Query embedding returned None")
-            break
-        except Exception as e:
-            last_err = e
-            time.sleep(backoff ** i)
-    else:
-        raise RuntimeError(f"Embedding failed after {retries} retries: {last_err}")
-
-    # embedding 成功后再走正常 query（此时基本不会 NoneType*float）
-    return query_engine.query(q)
+    deadline = Deadline(deadline_s)
+    hedge_p = HEDGE_PERCENTILE or None
+
+    # 先确保 query embedding 成功（避免 None）；慢了就 hedge，上游临时错误在预算内重试
+    def embed(timeout: float):
+        emb = make_embed_model(timeout).get_query_embedding(q)
+        if emb is None:
+            raise RuntimeError("Query embedding returned None")
+        return emb
+
+    nodes = []
+    try:
+        emb = hedged_call(
+            embed,
+            timeout=deadline.budget(EMBED_BUDGET),
+            stage="embed",
+            hedge_percentile=hedge_p,
+            retries=UPSTREAM_RETRIES,
+        )
+        # 复用上面的 embedding，检索不会再算一遍
+        bundle = QueryBundle(query_str=q, embedding=emb)
+        nodes = retriever.retrieve(bundle)
+        resp = hedged_call(
+            lambda t: get_response_synthesizer(
+                llm=make_llm(t), text_qa_template=qa_prompt
+            ).synthesize(bundle, nodes),
+            timeout=deadline.budget(),
+            stage="synthesize",
+            hedge_percentile=hedge_p,
+            retries=UPSTREAM_RETRIES,
+        )
+    except Exception as e:
+        # 超时，或检索完成后 LLM 出错：返回兜底回答 + 已检索到的来源
+        if not isinstance(e, DeadlineExceeded) and not nodes:
+            raise
+        print(f"\n[Warn] {e}")
+        return FALLBACK_ANSWER, nodes
+
+    return str(resp).strip(), resp.source_nodes
 
 
 while True:
@@ -75,19 +101,19 @@ while True:
         continue
 
     try:
-        resp = safe_query(q)
-        print("\n[VirtualTA]\n", resp)
+        answer, source_nodes = safe_query(q)
+        print("\n[VirtualTA]\n", answer)
 
         # print("requested top_k =", 10)
-        # print("returned source_nodes =", len(resp.source_nodes))
+        # print("returned source_nodes =", len(source_nodes))
 
-        # for i, sn in enumerate(resp.source_nodes, 1):
+        # for i, sn in enumerate(source_nodes, 1):
         #     url = sn.metadata.get("url")
         #     print(f"[{i}] score={sn.score:.4f} url={url}")
 
         seen = set()
         print("[Sources]")
-        for sn in resp.source_nodes:
+        for sn in source_nodes:
             url = sn.metadata.get("url")
             if url and url not in seen:
                 print("-", url)
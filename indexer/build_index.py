@@ -2,6 +2,13 @@
 import json
 import os
 
+# Load .env file if present，INDEX_SNAPSHOT_ROOT 等配置和 API server 保持一致
+try:
+    from dotenv import load_dotenv
+    load_dotenv()
+except ImportError:
+    pass  # python-dotenv not installed, use system env vars
+
 from llama_index.core import (
     VectorStoreIndex,
     SimpleDirectoryReader,
@@ -14,6 +21,9 @@ from llama_index.embeddings.openai import OpenAIEmbedding
 
 from urllib.parse import urlparse, urlunparse
 
+from indexer.dedup import dedup_nodes
+from indexer.snapshot import SNAPSHOT_ROOT, prune_snapshots, publish_snapshot, snapshot_dir
+
 # ---------- 基础配置 ----------
 Settings.llm = OpenAI(model="gpt-4o-mini", temperature=0)
 Settings.embed_model = OpenAIEmbedding(model="text-embedding-3-small")
@@ -21,7 +31,11 @@ Settings.embed_model = OpenAIEmbedding(model="text-embedding-3-small")
 # ---------- 路径 ----------
 URL_PATH = "data/raw/site_urls.json"
 PDF_PATH = "docs"
-INDEX_PATH = "data/processed/index"
+# 每次 build 写一个新版本到 SNAPSHOT_ROOT/<version>/，运行中的 server 会自动热切换
+KEEP_SNAPSHOTS = 3
+
+# 估计 Jaccard 相似度 >= 该值的 chunk 视为重复（exam 和 -sol 版本、跨学期 practice、网页模板）
+DEDUP_THRESHOLD = 0.85
 
 os.makedirs("data/processed", exist_ok=True)
 
@@ -104,9 +118,22 @@ print(f"[PDF] total={len(pdf_docs)} mapped_to_web={mapped} unmapped_website_pdfs
 all_docs = web_docs + pdf_docs
 print(f"Total documents: {len(all_docs)}")
 
-# ---------- 5️⃣ 建索引 ----------
-index = VectorStoreIndex.from_documents(all_docs)
+# ---------- 5️⃣ 切块 + 去重 ----------
+# 和 VectorStoreIndex.from_documents 用同一个默认 splitter
+nodes = Settings.node_parser.get_nodes_from_documents(all_docs)
+nodes, dedup_stats = dedup_nodes(nodes, threshold=DEDUP_THRESHOLD)
+print(
+    f"[Dedup] chunks={dedup_stats['input']} exact_dups={dedup_stats['exact']} "
+    f"near_dups={dedup_stats['near']} kept={dedup_stats['kept']}"
+)
+
+# ---------- 6️⃣ 建索引 ----------
+index = VectorStoreIndex(nodes)
+
+# ---------- 7️⃣ 持久化为新版本 ----------
+version = publish_snapshot(index, SNAPSHOT_ROOT)
+print(f"Index saved to {snapshot_dir(version)} (CURRENT -> {version})")
 
-# ---------- 6️⃣ 持久化 ----------
-index.storage_context.persist(persist_dir=INDEX_PATH)
-print(f"Index saved to {INDEX_PATH}")
+removed = prune_snapshots(SNAPSHOT_ROOT, keep=KEEP_SNAPSHOTS)
+if removed:
+    print(f"Pruned old snapshots: {', '.join(removed)}")
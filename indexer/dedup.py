@@ -0,0 +1,154 @@
+# indexer/dedup.py
+"""
+切块之后的去重：精确重复（规范化文本 hash）+ 近似重复（MinHash + LSH）。
+
+同一份内容只保留一个 node（canonical）：近似重复时保留更长的那个
+（例如 exam 和多了答案的 -sol 版本，保留 -sol），不依赖读取顺序；
+其它来源记到 canonical.metadata["duplicate_sources"]，引用不会丢。
+"""
+import hashlib
+import re
+from collections import defaultdict
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+DUP_SOURCES_KEY = "duplicate_sources"
+
+# x, a, b 都 < 2^31，a*x + b < 2^63，uint64 不会溢出
+_MERSENNE_PRIME = (1 << 31) - 1
+_WORD_RE = re.compile(r"[a-z0-9]+")
+
+
+def normalize_text(text: str) -> str:
+    """小写 + 只保留字母数字 token，忽略空白/标点差异（PDF 抽取经常不一致）。"""
+    return " ".join(_WORD_RE.findall(text.lower()))
+
+
+def _hash31(s: str) -> int:
+    h = int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=4).digest(), "big")
+    return h % _MERSENNE_PRIME
+
+
+def shingles(text: str, k: int = 5) -> List[int]:
+    """k-word shingles 的 hash（输入应已 normalize）。"""
+    words = text.split()
+    if len(words) <= k:
+        return [_hash31(" ".join(words))]
+    return sorted({_hash31(" ".join(words[i:i + k])) for i in range(len(words) - k + 1)})
+
+
+class MinHasher:
+    """num_perm 个 (a*x + b) mod p 置换，numpy 向量化计算签名。"""
+
+    def __init__(self, num_perm: int = 128, seed: int = 1):
+        rng = np.random.RandomState(seed)
+        self.num_perm = num_perm
+        self.a = rng.randint(1, _MERSENNE_PRIME, size=num_perm).astype(np.uint64)
+        self.b = rng.randint(0, _MERSENNE_PRIME, size=num_perm).astype(np.uint64)
+
+    def signature(self, hashes: Sequence[int]) -> np.ndarray:
+        hv = np.asarray(hashes, dtype=np.uint64)
+        perm = (np.outer(self.a, hv) + self.b[:, None]) % np.uint64(_MERSENNE_PRIME)
+        return perm.min(axis=1)
+
+
+def _source_of(md: Dict) -> str:
+    return md.get("file_path") or md.get("url") or md.get("source") or ""
+
+
+def dedup_nodes(
+    nodes: list,
+    threshold: float = 0.85,
+    num_perm: int = 128,
+    bands: int = 16,
+    shingle_size: int = 5,
+) -> Tuple[list, Dict[str, int]]:
+    """
+    返回 (保留的 nodes, 统计)。
+
+    先按规范化文本精确去重，再用 LSH 找候选、用估计的 Jaccard >= threshold 判定近似重复。
+    bands * rows 必须等于 num_perm；默认 16x8 时候选阈值约 0.7。
+    """
+    if num_perm % bands:
+        raise ValueError("num_perm must be divisible by bands")
+    rows = num_perm // bands
+    hasher = MinHasher(num_perm=num_perm)
+
+    kept: list = []
+    signatures: List[np.ndarray] = []
+    lengths: List[int] = []
+    exact: Dict[str, int] = {}
+    buckets: Dict[Tuple[int, bytes], List[int]] = defaultdict(list)
+    stats = {"input": len(nodes), "exact": 0, "near": 0}
+
+    def add_source(canon, src: str) -> None:
+        dups = canon.metadata.setdefault(DUP_SOURCES_KEY, [])
+        if src and src != _source_of(canon.metadata) and src not in dups:
+            dups.append(src)
+
+    def merge(canon_idx: int, node) -> None:
+        add_source(kept[canon_idx], _source_of(node.metadata or {}))
+
+    def replace(canon_idx: int, node) -> None:
+        """node 比现有 canonical 更完整：换它进来，旧 canonical 的来源一并继承。"""
+        old = kept[canon_idx]
+        kept[canon_idx] = node
+        for src in [_source_of(old.metadata or {})] + list(old.metadata.get(DUP_SOURCES_KEY) or []):
+            add_source(node, src)
+
+    for node in nodes:
+        norm = normalize_text(node.get_content())
+        if not norm:
+            kept.append(node)
+            signatures.append(np.zeros(num_perm, dtype=np.uint64))
+            lengths.append(0)
+            continue
+
+        key = hashlib.sha1(norm.encode("utf-8")).hexdigest()
+        if key in exact:
+            # 规范化后完全相同，没有内容差异，保留先出现的
+            merge(exact[key], node)
+            stats["exact"] += 1
+            continue
+
+        sig = hasher.signature(shingles(norm, shingle_size))
+        band_keys = [(b, sig[b * rows:(b + 1) * rows].tobytes()) for b in range(bands)]
+        length = len(norm)
+
+        match = None
+        candidates = {i for bk in band_keys for i in buckets.get(bk, ())}
+        for i in sorted(candidates):
+            if float(np.mean(signatures[i] == sig)) >= threshold:
+                match = i
+                break
+
+        if match is None:
+            match = len(kept)
+            kept.append(node)
+            signatures.append(sig)
+            lengths.append(length)
+        else:
+            stats["near"] += 1
+            if length <= lengths[match]:
+                merge(match, node)
+                continue
+            # 更长的版本（通常多出答案/补充说明）成为 canonical，避免丢内容
+            replace(match, node)
+            signatures[match] = sig
+            lengths[match] = length
+
+        exact[key] = match
+        for bk in band_keys:
+            if match not in buckets[bk]:
+                buckets[bk].append(match)
+
+    for node in kept:
+        # 只用于引用，不参与 embedding / LLM 上下文
+        for attr in ("excluded_embed_metadata_keys", "excluded_llm_metadata_keys"):
+            excluded = getattr(node, attr)
+            if DUP_SOURCES_KEY not in excluded:
+                excluded.append(DUP_SOURCES_KEY)
+
+    stats["kept"] = len(kept)
+    return kept, stats
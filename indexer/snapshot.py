@@ -0,0 +1,76 @@
+# indexer/snapshot.py
+"""
+版本化的索引快照:
+
+  data/processed/index_versions/
+    ├── 20261019-153000/     每次 build 一个目录，写完后不再修改
+    ├── 20261020-090000/
+    └── CURRENT              当前版本号（原子替换），API server 轮询它做热切换
+
+先写到临时目录再 rename，最后 os.replace 更新 CURRENT，
+正在运行的 server 永远不会读到写了一半的索引。
+
+builder 和 API server（app/rag_core.py）共用这里的目录布局和 CURRENT 读取逻辑。
+"""
+import os
+import shutil
+import time
+
+SNAPSHOT_ROOT = os.getenv("INDEX_SNAPSHOT_ROOT", "data/processed/index_versions")
+POINTER_NAME = "CURRENT"
+
+
+def new_version() -> str:
+    return time.strftime("%Y%m%d-%H%M%S", time.gmtime())
+
+
+def snapshot_dir(version: str, root: str = SNAPSHOT_ROOT) -> str:
+    return os.path.join(root, version)
+
+
+def read_current(root: str = SNAPSHOT_ROOT) -> str:
+    """CURRENT 指向的版本号；还没有快照时返回空字符串。"""
+    try:
+        with open(os.path.join(root, POINTER_NAME), "r") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return ""
+
+
+def publish_snapshot(index, root: str = SNAPSHOT_ROOT, version: str = "") -> str:
+    """持久化 index 为新版本并把 CURRENT 指过去，返回版本号。"""
+    version = version or new_version()
+    os.makedirs(root, exist_ok=True)
+
+    final_dir = snapshot_dir(version, root)
+    if os.path.exists(final_dir):
+        raise FileExistsError(f"Snapshot {final_dir} already exists")
+
+    tmp_dir = os.path.join(root, f".{version}.tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    index.storage_context.persist(persist_dir=tmp_dir)
+    os.rename(tmp_dir, final_dir)
+
+    tmp_ptr = os.path.join(root, f".{POINTER_NAME}.tmp")
+    with open(tmp_ptr, "w") as f:
+        f.write(version + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_ptr, os.path.join(root, POINTER_NAME))
+    return version
+
+
+def prune_snapshots(root: str = SNAPSHOT_ROOT, keep: int = 3) -> list:
+    """只保留最近 keep 个版本（CURRENT 指向的永远保留），返回删除的版本号。"""
+    current = read_current(root)
+    versions = sorted(
+        d for d in os.listdir(root)
+        if not d.startswith(".") and os.path.isdir(os.path.join(root, d))
+    )
+    removed = []
+    for v in versions[:-keep] if keep > 0 else versions:
+        if v == current:
+            continue
+        shutil.rmtree(snapshot_dir(v, root), ignore_errors=True)
+        removed.append(v)
+    return removed
@@ -0,0 +1,182 @@
+# loadtest/openai_stub.py
+"""
+本地 OpenAI 兼容 stub，用于压测（不花钱、不受上游限流影响）。
+
+实现:
+  - POST /v1/embeddings         确定性伪随机向量（同一文本 → 同一向量）
+  - POST /v1/chat/completions   固定回答，支持 stream=true (SSE)
+
+延迟模型: base ± jitter，另有 slow_rate 比例的请求额外加 slow_ms（模拟长尾）。
+
+用法:
+  python loadtest/openai_stub.py --port 9000 --latency-ms 800 --jitter-ms 200
+  OPENAI_API_BASE=http://localhost:9000/v1 OPENAI_API_KEY=sk-stub \\
+      uvicorn app.api:app --port 8000
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import random
+import time
+import uuid
+from typing import Any, Dict, List
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+# 默认与 text-embedding-3-small 维度一致，否则查询向量和索引对不上
+CONFIG: Dict[str, Any] = {
+    "latency_ms": 300.0,
+    "jitter_ms": 100.0,
+    "slow_rate": 0.0,
+    "slow_ms": 3000.0,
+    "embed_latency_ms": 50.0,
+    "embed_dim": 1536,
+    "stream_chunks": 20,
+    "chunk_interval_ms": 20.0,
+    "answer": (
+        "This is a canned answer from the local OpenAI stub. "
+        "Check the syllabus on the course website for the official policy."
+    ),
+}
+
+app = FastAPI(title="OpenAI stub")
+
+
+def _delay(base_ms: float) -> float:
+    """按配置生成一次延迟（秒）。"""
+    ms = base_ms + random.uniform(-CONFIG["jitter_ms"], CONFIG["jitter_ms"])
+    if CONFIG["slow_rate"] > 0 and random.random() < CONFIG["slow_rate"]:
+        ms += CONFIG["slow_ms"]
+    return max(ms, 0.0) / 1000.0
+
+
+def _fake_embedding(text: str) -> List[float]:
+    """文本 hash 作种子的单位向量。"""
+    seed = int.from_bytes(hashlib.sha1(text.encode("utf-8")).digest()[:8], "big")
+    rng = random.Random(seed)
+    vec = [rng.gauss(0.0, 1.0) for _ in range(CONFIG["embed_dim"])]
+    norm = math.sqrt(sum(v * v for v in vec)) or 1.0
+    return [v / norm for v in vec]
+
+
+def _usage(n: int) -> Dict[str, int]:
+    return {"prompt_tokens": n, "completion_tokens": 0, "total_tokens": n}
+
+
+@app.post("/v1/embeddings")
+async def embeddings(request: Request):
+    body = await request.json()
+    inputs = body.get("input", [])
+    if isinstance(inputs, str):
+        inputs = [inputs]
+
+    await asyncio.sleep(_delay(CONFIG["embed_latency_ms"]))
+
+    data = [
+        {"object": "embedding", "index": i, "embedding": _fake_embedding(str(t))}
+        for i, t in enumerate(inputs)
+    ]
+    tokens = sum(len(str(t).split()) for t in inputs)
+    return {
+        "object": "list",
+        "data": data,
+        "model": body.get("model", "stub-embedding"),
+        "usage": _usage(tokens),
+    }
+
+
+def _chunks(text: str, n: int) -> List[str]:
+    words = text.split(" ")
+    size = max(1, math.ceil(len(words) / max(n, 1)))
+    parts = [" ".join(words[i:i + size]) for i in range(0, len(words), size)]
+    return [p if i == 0 else " " + p for i, p in enumerate(parts)]
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    model = body.get("model", "stub-chat")
+    cid = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+    created = int(time.time())
+    answer = CONFIG["answer"]
+
+    # 首 token 延迟
+    await asyncio.sleep(_delay(CONFIG["latency_ms"]))
+
+    if not body.get("stream"):
+        return {
+            "id": cid,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": answer},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": _usage(len(answer.split())),
+        }
+
+    async def event_stream():
+        def chunk(delta: Dict[str, Any], finish: Any = None) -> str:
+            payload = {
+                "id": cid,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish}],
+            }
+            return f"data: {json.dumps(payload)}\n\n"
+
+        yield chunk({"role": "assistant", "content": ""})
+        for part in _chunks(answer, CONFIG["stream_chunks"]):
+            yield chunk({"content": part})
+            await asyncio.sleep(CONFIG["chunk_interval_ms"] / 1000.0)
+        yield chunk({}, finish="stop")
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
+@app.get("/v1/models")
+def models():
+    return {"object": "list", "data": [{"id": "stub-chat", "object": "model"}]}
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Local OpenAI-compatible stub")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=9000)
+    ap.add_argument("--latency-ms", type=float, default=CONFIG["latency_ms"],
+                    help="chat 首 token 基础延迟")
+    ap.add_argument("--jitter-ms", type=float, default=CONFIG["jitter_ms"])
+    ap.add_argument("--slow-rate", type=float, default=CONFIG["slow_rate"],
+                    help="额外加 --slow-ms 的请求比例 (0~1)")
+    ap.add_argument("--slow-ms", type=float, default=CONFIG["slow_ms"])
+    ap.add_argument("--embed-latency-ms", type=float, default=CONFIG["embed_latency_ms"])
+    ap.add_argument("--embed-dim", type=int, default=CONFIG["embed_dim"])
+    ap.add_argument("--stream-chunks", type=int, default=CONFIG["stream_chunks"])
+    ap.add_argument("--chunk-interval-ms", type=float, default=CONFIG["chunk_interval_ms"])
+    args = ap.parse_args()
+
+    CONFIG.update(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        slow_rate=args.slow_rate,
+        slow_ms=args.slow_ms,
+        embed_latency_ms=args.embed_latency_ms,
+        embed_dim=args.embed_dim,
+        stream_chunks=args.stream_chunks,
+        chunk_interval_ms=args.chunk_interval_ms,
+    )
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
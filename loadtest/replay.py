@@ -0,0 +1,198 @@
+# loadtest/replay.py
+"""
+回放录制的流量（TRAFFIC_LOG_PATH 写出的 JSONL），压测正在运行的 API server。
+
+开环回放：按原始到达间隔发请求（--speed 缩放），不等前一个请求返回，
+这样才能看出 server 的排队和限流行为。
+
+用法:
+  python loadtest/replay.py data/traffic.jsonl --url http://localhost:8000 --speed 4
+  python loadtest/replay.py data/traffic.jsonl --rate 5 --limit 500   # 固定 5 req/s
+
+报告: 吞吐、延迟分位数、429 / 错误率、server 端排队延迟 (X-Queue-Delay-Ms)。
+"""
+import argparse
+import json
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import requests
+
+
+def load_traffic(path: str, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            records.append(json.loads(line))
+            if limit and len(records) >= limit:
+                break
+    records.sort(key=lambda r: r.get("ts", 0.0))
+    return records
+
+
+def schedule(records: List[Dict[str, Any]], speed: float, rate: Optional[float]) -> List[float]:
+    """每条请求相对开始时间的发送偏移（秒）。"""
+    if rate:
+        return [i / rate for i in range(len(records))]
+    if not records:
+        return []
+    t0 = records[0].get("ts", 0.0)
+    return [(r.get("ts", t0) - t0) / speed for r in records]
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    """最近秩 (nearest-rank) 分位数。"""
+    if not values:
+        return None
+    xs = sorted(values)
+    k = max(0, min(len(xs) - 1, math.ceil(p / 100.0 * len(xs)) - 1))
+    return xs[k]
+
+
+def send_one(session: requests.Session, url: str, rec: Dict[str, Any], timeout: float) -> Dict[str, Any]:
+    payload = {
+        "question": rec["question"],
+        "prompt_name": rec.get("prompt_name", "ta_friendly"),
+        "top_k": rec.get("top_k", 10),
+    }
+    start = time.perf_counter()
+    try:
+        r = session.post(f"{url}/query", json=payload, timeout=timeout)
+        latency = time.perf_counter() - start
+        queue_ms = r.headers.get("X-Queue-Delay-Ms")
+        return {
+            "status": r.status_code,
+            "latency": latency,
+            "queue_delay": float(queue_ms) / 1000.0 if queue_ms else None,
+            "error": None,
+        }
+    except requests.RequestException as e:
+        return {
+            "status": None,
+            "latency": time.perf_counter() - start,
+            "queue_delay": None,
+            "error": type(e).__name__,
+        }
+
+
+def replay(
+    records: List[Dict[str, Any]],
+    url: str,
+    speed: float = 1.0,
+    rate: Optional[float] = None,
+    workers: int = 256,
+    timeout: float = 60.0,
+) -> Dict[str, Any]:
+    offsets = schedule(records, speed, rate)
+    results: List[Dict[str, Any]] = []
+    lock = threading.Lock()
+    local = threading.local()
+
+    def session() -> requests.Session:
+        # requests.Session 不保证线程安全，每个线程一个
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        return local.session
+
+    def task(rec: Dict[str, Any], planned: float, t0: float):
+        lag = time.perf_counter() - t0 - planned
+        res = send_one(session(), url, rec, timeout)
+        res["schedule_lag"] = lag
+        with lock:
+            results.append(res)
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for rec, planned in zip(records, offsets):
+            wait = planned - (time.perf_counter() - t0)
+            if wait > 0:
+                time.sleep(wait)
+            pool.submit(task, rec, planned, t0)
+    wall = time.perf_counter() - t0
+
+    return summarize(results, wall)
+
+
+def summarize(results: List[Dict[str, Any]], wall: float) -> Dict[str, Any]:
+    n = len(results)
+    ok = [r for r in results if r["status"] is not None and 200 <= r["status"] < 300]
+    throttled = [r for r in results if r["status"] == 429]
+    n_err = n - len(ok) - len(throttled)
+
+    def dist(values: List[float]) -> Dict[str, Optional[float]]:
+        return {f"p{p}": percentile(values, p) for p in (50, 90, 95, 99)} | {
+            "max": max(values) if values else None
+        }
+
+    queue = [r["queue_delay"] for r in ok if r["queue_delay"] is not None]
+    return {
+        "requests": n,
+        "wall_s": wall,
+        "offered_rps": n / wall if wall else None,
+        "throughput_rps": len(ok) / wall if wall else None,
+        "ok_rate": len(ok) / n if n else None,
+        "rate_429": len(throttled) / n if n else None,
+        "error_rate": n_err / n if n else None,
+        "latency_ok_s": dist([r["latency"] for r in ok]),
+        "queue_delay_s": dist(queue),
+        "schedule_lag_s": dist([r["schedule_lag"] for r in results]),
+    }
+
+
+def print_report(rep: Dict[str, Any]) -> None:
+    def fmt(v: Optional[float], unit: str = "") -> str:
+        return "-" if v is None else f"{v:.3f}{unit}"
+
+    print(f"requests        : {rep['requests']} in {rep['wall_s']:.1f}s")
+    print(f"offered load    : {fmt(rep['offered_rps'], ' req/s')}")
+    print(f"throughput (2xx): {fmt(rep['throughput_rps'], ' req/s')}")
+    print(f"ok / 429 / error: {fmt(rep['ok_rate'])} / {fmt(rep['rate_429'])} / {fmt(rep['error_rate'])}")
+    for key, label in (
+        ("latency_ok_s", "latency (2xx)"),
+        ("queue_delay_s", "server queueing"),
+        ("schedule_lag_s", "client lag"),
+    ):
+        d = rep[key]
+        cells = "  ".join(f"{k}={fmt(v, 's')}" for k, v in d.items())
+        print(f"{label:<16}: {cells}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Replay recorded /query traffic against a running server")
+    ap.add_argument("traffic", help="JSONL written by TRAFFIC_LOG_PATH")
+    ap.add_argument("--url", default="http://localhost:8000")
+    ap.add_argument("--speed", type=float, default=1.0, help="时间轴缩放，2.0 = 两倍速")
+    ap.add_argument("--rate", type=float, default=None, help="忽略原始时间戳，固定 req/s")
+    ap.add_argument("--limit", type=int, default=None, help="只回放前 N 条")
+    ap.add_argument("--workers", type=int, default=256, help="最大并发连接数")
+    ap.add_argument("--timeout", type=float, default=60.0)
+    ap.add_argument("--json", action="store_true", help="以 JSON 输出报告")
+    args = ap.parse_args()
+
+    records = load_traffic(args.traffic, args.limit)
+    if not records:
+        print("No traffic records found.")
+        return
+
+    rep = replay(
+        records,
+        url=args.url.rstrip("/"),
+        speed=args.speed,
+        rate=args.rate,
+        workers=args.workers,
+        timeout=args.timeout,
+    )
+    if args.json:
+        print(json.dumps(rep, indent=2))
+    else:
+        print_report(rep)
+
+
+if __name__ == "__main__":
+    main()